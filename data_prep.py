@@ -11,6 +11,8 @@ Avalable functions:
 - download_unsplash_json
 - download_images
 - do_image_processing
+- create_thumbnail
+- download_and_process_images
 
 Usage:
 
@@ -26,21 +28,81 @@ Get pandas dataframe.
 Download images to data/ images folder.
 >>> data_prep.download_images()
 
-Create thumbnail images from existing images in data/ images folder.
+Apply image processing operations to images in data/ images folder.
 >>> data_prep.do_image_processing()
 
+Create thumbnail images from existing images in data/ images folder.
+>>> data_prep.create_thumbnail()
+
+Download images and create thumbnails in one pipeline.
+>>> data_prep.download_and_process_images()
+
 """
+import asyncio
 import configparser
 import datetime
 import functools
-import json
+import io
 import os
 import pathlib
-import sys
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
+import aiohttp
+import orjson
 import pandas as pd
 import requests
+from aiolimiter import AsyncLimiter
 from PIL import Image, UnidentifiedImageError
+from tqdm.auto import tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# jpegtran-cffi does rotate/flip losslessly in the dct domain,
+# skipping the decode + re-encode cycle; fall back to PIL when
+# the c extension is not installed
+try:
+    from jpegtran import JPEGImage
+except ImportError:
+    JPEGImage = None
+
+# PyTurboJPEG decodes jpgs with libjpeg-turbo's simd idct,
+# roughly twice as fast as the stock Pillow path; fall back
+# to PIL when the library is not installed
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _TURBO_JPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _TURBO_JPEG = None
+
+# shared session so repeated downloads reuse pooled connections
+# instead of paying a tcp + tls handshake per image; transient
+# errors are retried with exponential backoff instead of losing
+# the image silently
+_RETRIES = Retry(
+    total=5, backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset(['GET']))
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16, pool_maxsize=64, max_retries=_RETRIES))
+
+
+def _make_session():
+    """
+    Creates an aiohttp client session with a connector tuned
+    for many concurrent downloads from the same host: cached
+    dns lookups and reusable keep-alive connections, so only
+    the first request per connection pays dns + tls setup.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=256, limit_per_host=64,
+        ttl_dns_cache=300, enable_cleanup_closed=True)
+
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=30, connect=10))
 
 
 def add_keyboard_interrupt(func):
@@ -48,39 +110,14 @@ def add_keyboard_interrupt(func):
     Decorator to detect keyboard interrupts by user.
     """
     @functools.wraps(func)
-    def wrapper():
+    def wrapper(*args, **kwargs):
         try:
-            func()
+            func(*args, **kwargs)
         except KeyboardInterrupt:
             print('Operation interrupted by user.')
     return wrapper
 
 
-def progressbar(it, prefix="", size=60, file=sys.stdout):
-    """
-    Progress bar function for long processes.
-    it      : iterator
-    prefix  : custom string to add on progress bar.
-    size    : size of the progress bar
-    file    : where the progress bar runs.
-    For more information, check the original answer from
-    stackoverflow, https://stackoverflow.com/a/34482761.
-    """
-    count = len(it)
-
-    def show(j):
-        x = int(size*j/count)
-        file.write("%s[%s%s] %i/%i\r" %
-                   (prefix, "#"*x, "."*(size-x), j, count))
-        file.flush()
-    show(0)
-    for i, item in enumerate(it):
-        yield item
-        show(i+1)
-    file.write("\n")
-    file.flush()
-
-
 def create_config_file(access_key='', secret_key=''):
     """
     Creates a config file for secret stuff. Option to provide keys.
@@ -110,9 +147,12 @@ def create_config_file(access_key='', secret_key=''):
             print('Config file setup properly.')
 
 
+@functools.lru_cache(maxsize=1)
 def get_images_list():
     """
     Get a list of all images from `data/json` folder.
+    The result is cached, so the json files are only parsed
+    once per session; returned as tuple to keep it hashable.
     """
     images_list = []
 
@@ -121,26 +161,126 @@ def get_images_list():
 
     # open files and collect all dictionaries
     for json_file in json_files:
-        with open(json_file, 'r') as reader:
-            raw_json = json.load(reader)
-            images_list.extend(raw_json)
+        raw_json = orjson.loads(json_file.read_bytes())
+        images_list.extend(raw_json)
 
-    return images_list
+    return tuple(images_list)
 
 
 def get_images_df():
     """
-    Returns a dataframe of the json in data/json folder.
+    Returns a dataframe of the json in data/json folder,
+    with nested dictionaries flattened into underscore
+    separated columns. The dataframe is cached as parquet
+    on first call, so later calls skip the json parsing
+    entirely.
     """
-    images_list = get_images_list()
+    parquet_path = pathlib.Path('data/json/_merged.parquet')
+
+    if parquet_path.exists():
+        return pd.read_parquet(parquet_path)
+
+    # flatten nested dicts and narrow the known unsplash
+    # columns instead of leaving everything as object dtype
+    images_df = pd.json_normalize(list(get_images_list()), sep='_')
+
+    # only narrow columns that are actually present, so an empty
+    # metadata folder still yields an empty frame instead of a
+    # KeyError from the dtype mapping
+    dtypes = {'width': 'int32', 'height': 'int32', 'likes': 'int32'}
+    images_df = images_df.astype(
+        {k: v for k, v in dtypes.items() if k in images_df}, errors='ignore')
+
+    # unsplash timestamps carry a utc offset, which astype
+    # cannot parse; to_datetime handles them
+    if 'created_at' in images_df:
+        images_df['created_at'] = pd.to_datetime(
+            images_df['created_at'], utc=True)
 
-    return pd.DataFrame(images_list)
+    images_df.to_parquet(parquet_path)
+
+    return images_df
+
+
+async def _fetch_unsplash_page(session, limiter, client_id):
+    """
+    Fetches one page of 30 random images meta information
+    from unsplash api, respecting the hourly rate limit.
+
+    Parameters:
+    session :
+        Shared aiohttp client session.
+    limiter :
+        Token-bucket limiter shared by all page fetches.
+    client_id :
+        Unsplash access key.
+    """
+    for attempt in range(5):
+        backoff = min(60, 2 ** attempt)
+
+        try:
+            async with limiter:
+                async with session.get(
+                    'https://api.unsplash.com/photos/random/?count=30',
+                    headers={
+                        'Accept-Version': 'v1',
+                        'Authorization': f'Client-ID {client_id}'
+                    }
+                ) as response:
+
+                    if response.status == 200:
+                        return orjson.loads(await response.read())
+
+                    if response.status not in (403, 429):
+                        print('Something went wrong!')
+                        return []
+
+                    # back off until the api gives us tokens again;
+                    # Retry-After may also be an http date, keep the
+                    # exponential backoff when it is not in seconds
+                    try:
+                        backoff = int(response.headers['Retry-After'])
+                    except (KeyError, ValueError):
+                        pass
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # transient network error, fall through to backoff
+            pass
+
+        await asyncio.sleep(backoff)
+
+    print('Api limit reached!')
+    return []
+
+
+async def _download_unsplash_json_async(client_id, images_list):
+    """
+    Downloads all meta information pages concurrently,
+    throttled to 50 requests per hour. Extends the given
+    images_list in place as pages finish, so the caller still
+    has the fetched pages when the run is interrupted.
+    """
+    limiter = AsyncLimiter(max_rate=50, time_period=3600)
+
+    async with _make_session() as session:
+        tasks = [
+            asyncio.ensure_future(_fetch_unsplash_page(session, limiter, client_id))
+            for _ in range(0, 1500, 30)
+        ]
+
+        for task in tqdm(tasks, desc='Downloading'):
+            # keep the pages that did succeed even when one
+            # fails unexpectedly
+            try:
+                images_list.extend(await task)
+            except Exception as ex:
+                print('Something went wrong', ex)
 
 
 def download_unsplash_json():
     """
     Downloads images meta information from unsplash website
-    as JSON with serial programming..
+    as JSON with asynchronous programming.
     """
     images_list = []
 
@@ -155,35 +295,28 @@ def download_unsplash_json():
         raise Exception('No key is provided, please get your key.')
 
     try:
-        for cnt in progressbar(it=range(0, 1500, 30), prefix='Downloading '):
-            response = requests.get(
-                f'https://api.unsplash.com/photos/random/?count=30',
-                headers={
-                    'Accept-Version': 'v1',
-                    'Authorization': f'Client-ID {client_id}'
-                },
-                stream=True
-            )
-
-            if response.status_code == 200:
-                raw_json = json.loads(response.content)
-                images_list.extend(raw_json)
-
-            elif response.status_code == 403:
-                print('Api limit reached!')
-                break
-            else:
-                print('Something went wrong!')
-                break
+        asyncio.run(_download_unsplash_json_async(client_id, images_list))
 
     except KeyboardInterrupt:
         print('Operation interrupted by user.')
     except Exception as ex:
         print('Something went wrong', ex)
     finally:
-        append_timestamp = round(datetime.datetime.now().timestamp())
-        with open(f'data/json/data_{append_timestamp}.json', 'w+') as writer:
-            json.dump(images_list, writer, indent=4)
+        # only write a file when something was fetched, so a failed
+        # run does not leave an empty data*.json behind for
+        # get_images_list to merge forever
+        if images_list:
+            append_timestamp = round(datetime.datetime.now().timestamp())
+            with open(f'data/json/data_{append_timestamp}.json', 'wb+') as writer:
+                writer.write(orjson.dumps(images_list, option=orjson.OPT_INDENT_2))
+
+            # the new file makes both caches stale: drop the
+            # memoized list and the parquet frame so the next
+            # call re-reads all data*.json files
+            get_images_list.cache_clear()
+            pathlib.Path('data/json/_merged.parquet').unlink(missing_ok=True)
+        else:
+            print('Nothing downloaded, no file written.')
 
 
 def single_download_image(url, image_path):
@@ -196,44 +329,177 @@ def single_download_image(url, image_path):
     image_path: 
         Place to save downloaded image.
     """
+    image_path = pathlib.Path(image_path)
+
+    # skip files a previous run already downloaded
+    if image_path.exists() and image_path.stat().st_size > 0:
+        return image_path
+
+    part_path = image_path.with_name(image_path.name + '.part')
+
     try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(image_path, 'wb+') as f:
-                f.write(response.content)
-    except:
+        with _SESSION.get(url, stream=True) as response:
+            if response.status_code == 200:
+                # stream 64 kb chunks to disk instead of holding
+                # the whole image in memory
+                response.raw.decode_content = True
+                with open(part_path, 'wb+') as f:
+                    shutil.copyfileobj(response.raw, f, length=1 << 16)
+                part_path.rename(image_path)
+    except requests.RequestException:
         pass
 
     return image_path
 
 
+def _iter_source_jpgs(root='data/images'):
+    """
+    Yields full paths of source jpg files under given folder,
+    skipping previously created thumbnail files. os.scandir
+    avoids the extra stat calls a recursive glob pays.
+    """
+    for entry in os.scandir(root):
+        if (entry.is_file()
+                and entry.name.endswith('.jpg')
+                and not entry.name.endswith('-thumbnail.jpg')):
+            yield entry.path
+
+
+def _decode_jpeg(data):
+    """
+    Decodes jpeg bytes with libjpeg-turbo when available,
+    falling back to PIL otherwise.
+    """
+    if _TURBO_JPEG is not None:
+        return Image.fromarray(
+            _TURBO_JPEG.decode(data, pixel_format=TJPF_RGB))
+
+    return Image.open(io.BytesIO(data))
+
+
+def _open_image(filepath):
+    """
+    Opens an image file, decoding jpgs with libjpeg-turbo
+    when available and falling back to PIL otherwise.
+    """
+    if _TURBO_JPEG is not None and filepath.endswith('.jpg'):
+        with open(filepath, 'rb') as reader:
+            return _decode_jpeg(reader.read())
+
+    return Image.open(filepath)
+
+
 def single_image_processing(filepath):
     """
     Do single image processing actions on given image file.
+    filepath is a plain string so it stays picklable for
+    process pool workers.
     """
     Image.MAX_IMAGE_PIXELS = None
     try:
-        # open file
-        image = Image.open(filepath)
+        # PIL operations return new images instead of mutating,
+        # so chain the results; each step now feeds the next
+        # instead of doing full-frame work that is thrown away.
+        # the rotate(270) that used to follow rotate(90) is gone,
+        # the pair cancelled out to a no-op.
+        if JPEGImage is not None and filepath.endswith('.jpg'):
+            # flip and rotate work losslessly on the jpeg dct
+            # coefficients, no pixel decode needed
+            jpeg = JPEGImage(filepath).flip('horizontal').rotate(90)
+            image = _decode_jpeg(jpeg.as_blob())
+        else:
+            image = _open_image(filepath)
+            image = image.transpose(Image.FLIP_LEFT_RIGHT).rotate(90)
 
-        # image processing operations
-        image.transpose(Image.FLIP_LEFT_RIGHT)
-        image.rotate(90)
-        image.rotate(270)
-        image.resize((400, 400))
-        image.convert('L')
-        image.convert('RGB')
-        image.thumbnail((128, 128))
+        # pixel-domain operations stay on PIL
+        image = image.resize((400, 400), Image.LANCZOS)
+        image = image.convert('L').convert('RGB')
+        image.thumbnail((128, 128), Image.LANCZOS)
 
     except UnidentifiedImageError:
         pass
 
 
+async def _fetch(session, semaphore, image, quality):
+    """
+    Downloads a single image url and saves it to
+    data/ images folder.
+
+    Parameters:
+    session :
+        Shared aiohttp client session.
+    semaphore :
+        Semaphore that bounds the number of downloads in flight.
+    image :
+        Image meta information dictionary from unsplash.
+    quality :
+        Image quality to download.
+    """
+    id = image['id']
+    url_quality = image['urls'][quality]
+    image_path = pathlib.Path(f'data/images/{id}-{quality}.jpg')
+
+    # skip files a previous run already downloaded
+    if image_path.exists() and image_path.stat().st_size > 0:
+        return image_path
+
+    part_path = image_path.with_name(image_path.name + '.part')
+
+    async with semaphore:
+        for attempt in range(5):
+            try:
+                async with session.get(url_quality) as response:
+                    if response.status == 200:
+                        # stream 64 kb chunks to disk instead of holding
+                        # the whole image in memory, offloading each
+                        # blocking write to the default executor so 64
+                        # concurrent streams never stall the event loop;
+                        # then rename so interrupted runs never leave a
+                        # partial file under the final name
+                        loop = asyncio.get_event_loop()
+                        with open(part_path, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(1 << 16):
+                                await loop.run_in_executor(None, f.write, chunk)
+                        part_path.rename(image_path)
+                        return image_path
+
+                    if response.status not in (429, 500, 502, 503, 504):
+                        return image_path
+
+                # transient server-side status, fall through to backoff
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # transient network error, fall through to backoff
+                pass
+
+            await asyncio.sleep(min(30, 0.5 * 2 ** attempt))
+
+    return image_path
+
+
+async def _download_images_async(quality):
+    """
+    Downloads all images concurrently with asyncio,
+    keeping at most 64 downloads in flight.
+    """
+    images_list = get_images_list()
+
+    semaphore = asyncio.Semaphore(64)
+
+    async with _make_session() as session:
+        tasks = [
+            asyncio.ensure_future(_fetch(session, semaphore, image, quality))
+            for image in images_list
+        ]
+
+        for task in tqdm(tasks, desc='Downloading'):
+            await task
+
+
 @add_keyboard_interrupt
 def download_images(quality='regular'):
     """
     Downloads images from given image quality with
-    serial programming.
+    asynchronous programming.
 
     Parameters:
     quality : Options are raw | full | regular | small | thumb
@@ -241,26 +507,258 @@ def download_images(quality='regular'):
     For more information about quality, check unsplash documentation at
     https://unsplash.com/documentation#example-image-use
     """
+    asyncio.run(_download_images_async(quality))
+
+
+@add_keyboard_interrupt
+def do_image_processing():
+    """
+    Applies image processing operations to given
+    list of files with parallel programming, one
+    process per cpu core.
+    """
+    images_path_list = list(_iter_source_jpgs())
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(
+            single_image_processing, images_path_list, chunksize=16)
+
+        for _ in tqdm(results, desc='Processing', total=len(images_path_list)):
+            pass
+
+
+def _process_image_bytes(data, id, quality):
+    """
+    Saves downloaded image bytes and a thumbnail made from
+    them, without reading the image back from disk.
+
+    Parameters:
+    data :
+        Raw image bytes as downloaded.
+    id :
+        Unsplash image id.
+    quality :
+        Image quality the bytes were downloaded from.
+    """
+    Image.MAX_IMAGE_PIXELS = None
+
+    image_path = f'data/images/{id}-{quality}.jpg'
+
+    # write to a .part file and rename, so a worker killed
+    # mid-write never leaves a truncated file under the final
+    # name that the skip check would trust on the next run
+    part_path = pathlib.Path(image_path + '.part')
+    part_path.write_bytes(data)
+    part_path.rename(image_path)
+
+    try:
+        image = Image.open(io.BytesIO(data))
+
+        if image.format == 'JPEG':
+            image.draft('RGB', (256, 256))
+
+        image.thumbnail((128, 128), Image.LANCZOS)
+        image.convert('RGB').save(
+            image_path.replace('.jpg', '-thumbnail.jpg'), 'JPEG',
+            quality=85, optimize=True, progressive=True)
+
+    except UnidentifiedImageError:
+        pass
+
+
+def _process_shared_image(shm_name, size, id, quality):
+    """
+    Process pool entry point for the pipeline. Reads the
+    downloaded bytes out of shared memory, frees the segment
+    and runs the normal processing on them.
+
+    Parameters:
+    shm_name :
+        Name of the shared memory segment holding the bytes.
+    size :
+        Number of payload bytes in the segment.
+    id :
+        Unsplash image id.
+    quality :
+        Image quality the bytes were downloaded from.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+    _process_image_bytes(data, id, quality)
+
+
+async def _download_to_queue(session, semaphore, queue, image, quality):
+    """
+    Downloads a single image and puts its bytes on the
+    pipeline queue.
+    """
+    image_path = pathlib.Path(f'data/images/{image["id"]}-{quality}.jpg')
+
+    # skip files a previous run already downloaded
+    if image_path.exists() and image_path.stat().st_size > 0:
+        return
+
+    async with semaphore:
+        for attempt in range(5):
+            try:
+                async with session.get(image['urls'][quality]) as response:
+                    if response.status == 200:
+                        data = await response.read()
+                        break
+
+                    if response.status not in (429, 500, 502, 503, 504):
+                        return
+
+                # transient server-side status, fall through to backoff
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # transient network error, fall through to backoff
+                pass
+
+            await asyncio.sleep(min(30, 0.5 * 2 ** attempt))
+        else:
+            return
+
+        if not data:
+            return
+
+        # hand the payload over through shared memory, so it is
+        # not pickled and copied again on its way into the
+        # process pool
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[:len(data)] = data
+        shm.close()
+
+        await queue.put((image['id'], shm.name, len(data)))
+
+
+async def _process_from_queue(queue, executor, quality):
+    """
+    Takes downloaded image bytes off the pipeline queue and
+    processes them in the process pool, until a None sentinel
+    arrives.
+    """
+    loop = asyncio.get_event_loop()
+
+    while True:
+        item = await queue.get()
+
+        if item is None:
+            break
+
+        id, shm_name, size = item
+
+        # a failed image must not kill this consumer: with the
+        # consumer gone the bounded queue fills up and every
+        # downloader blocks forever on queue.put
+        try:
+            await loop.run_in_executor(
+                executor, _process_shared_image, shm_name, size, id, quality)
+        except Exception as ex:
+            print('Something went wrong', ex)
+
+
+async def _download_and_process_images_async(quality):
+    """
+    Runs the download and processing stages concurrently,
+    connected by a bounded queue for backpressure so memory
+    stays flat when downloads outpace processing.
+    """
     images_list = get_images_list()
 
-    for image in progressbar(it=images_list, prefix='Downloading '):
-        # build necessary information
-        id = image['id']
-        url_quality = image['urls'][quality]
-        image_path = pathlib.Path(f'data/images/{id}-{quality}.jpg')
+    semaphore = asyncio.Semaphore(64)
+    queue = asyncio.Queue(maxsize=256)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        async with _make_session() as session:
+            processors = [
+                asyncio.ensure_future(
+                    _process_from_queue(queue, executor, quality))
+                for _ in range(os.cpu_count())
+            ]
+            downloads = [
+                asyncio.ensure_future(
+                    _download_to_queue(session, semaphore, queue, image, quality))
+                for image in images_list
+            ]
 
-        # download and save image
-        single_download_image(url_quality, image_path)
+            for task in tqdm(downloads, desc='Downloading'):
+                await task
+
+            # all downloads are queued, tell processors to stop
+            for _ in processors:
+                await queue.put(None)
+
+            await asyncio.gather(*processors)
 
 
 @add_keyboard_interrupt
-def do_image_processing():
+def download_and_process_images(quality='regular'):
+    """
+    Downloads images and creates their thumbnails in a single
+    pipeline, so images are processed from memory instead of
+    being written, re-read and decoded from disk again.
+
+    Parameters:
+    quality : Options are raw | full | regular | small | thumb
+
+    For more information about quality, check unsplash documentation at
+    https://unsplash.com/documentation#example-image-use
     """
-    Applies image processing operations to given 
-    list of files with serial programming.
+    asyncio.run(_download_and_process_images_async(quality))
+
+
+def single_create_thumbnail(filepath, size=(128, 128)):
+    """
+    Creates a thumbnail file next to the given image file,
+    with a `-thumbnail` suffix.
+
+    Parameters:
+    filepath :
+        Image file to create a thumbnail from, as string.
+    size :
+        Thumbnail size as (width, height) tuple.
     """
-    images_path_list = list(pathlib.Path(
-        f'data/images').glob('**/*.jpg'))
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        image = Image.open(filepath)
+
+        # let libjpeg decode at a reduced dct scale, so a
+        # multi-megapixel jpg is never fully decoded just
+        # to be shrunk down to a thumbnail
+        if image.format == 'JPEG':
+            image.draft('RGB', (size[0] * 2, size[1] * 2))
+
+        image.thumbnail(size, Image.LANCZOS)
+        image.convert('RGB').save(
+            filepath.replace('.jpg', '-thumbnail.jpg'), 'JPEG',
+            quality=85, optimize=True, progressive=True)
+
+    except UnidentifiedImageError:
+        pass
+
+
+@add_keyboard_interrupt
+def create_thumbnail(size=(128, 128)):
+    """
+    Creates thumbnail files for all images in data/ images
+    folder with parallel programming, one process per cpu core.
+
+    Parameters:
+    size :
+        Thumbnail size as (width, height) tuple.
+    """
+    images_path_list = list(_iter_source_jpgs())
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(
+            functools.partial(single_create_thumbnail, size=size),
+            images_path_list, chunksize=16)
 
-    for image_path in progressbar(it=images_path_list, prefix='Processing '):
-        single_image_processing(image_path.absolute())
+        for _ in tqdm(results, desc='Processing', total=len(images_path_list)):
+            pass